@@ -22,6 +22,7 @@ import sys
 import logging
 
 logging.basicConfig(level=logging.INFO)
+_logger = logging.getLogger(__name__)
 
 items = []
 
@@ -40,10 +41,13 @@ else:
 ig = spead2.ItemGroup()
 num_heaps = 0
 for heap in stream:
-    print("Got heap", heap.cnt)
+    _logger.info("Got heap %d", heap.cnt)
     items = ig.update(heap)
-    for item in items.values():
-        print(heap.cnt, item.name, item.value)
+    # Formatting item values is expensive, so skip it entirely unless the
+    # output will actually be shown
+    if _logger.isEnabledFor(logging.DEBUG):
+        for item in items.values():
+            _logger.debug("%d %s %s", heap.cnt, item.name, item.value)
     num_heaps += 1
 stream.stop()
 print("Received", num_heaps, "heaps")
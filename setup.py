@@ -124,6 +124,7 @@ setup(
     cmdclass={'build_ext': BuildExt},
     setup_requires=['numpy'],
     install_requires=['numpy>=1.9.2', 'six'],
+    extras_require={'numba': ['numba']},
     tests_require=['netifaces', 'nose', 'decorator', 'trollius'],
     test_suite='nose.collector',
     packages=['spead2', 'spead2.recv', 'spead2.send'],
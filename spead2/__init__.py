@@ -40,10 +40,14 @@ from spead2._spead2 import (
     CTRL_DESCRIPTOR_UPDATE,
     MEMCPY_STD,
     MEMCPY_NONTEMPORAL)
+import ast as _ast
+import binascii as _binascii
+import math as _math
 import numbers as _numbers
 import numpy as _np
 import logging
 import six
+from spead2 import _bitcodec
 from spead2._version import __version__
 
 
@@ -59,11 +63,17 @@ if six.PY2:
     def _bytes_to_str_ascii(b):
         b.decode('ascii')  # Just to check validity, throw away unicode object
         return b
+
+    def _int_from_bytes(data):
+        return int(_binascii.hexlify(bytes(bytearray(data))), 16)
 else:
     # Python 3
     def _bytes_to_str_ascii(b):
         return b.decode('ascii')
 
+    def _int_from_bytes(data):
+        return int.from_bytes(data, 'big')
+
 
 def _shape_elements(shape):
     elements = 1
@@ -72,6 +82,120 @@ def _shape_elements(shape):
     return elements
 
 
+if hasattr(_math, 'prod'):
+    # C implementation, available on Python 3.8+
+    _shape_elements = _math.prod
+
+
+_format_codecs = {}
+
+
+def _compile_format_codec(format):
+    """Generate specialized per-element decode/encode functions for a format.
+
+    The format of a descriptor is fixed at construction, so rather than
+    re-dispatching on the field codes for every field of every element,
+    generate a pair of straight-line functions specialized for the format
+    and compile them once. The results are cached per format tuple, since
+    the same formats tend to recur across descriptors.
+
+    Returns
+    -------
+    decode : callable
+        Takes the ``send`` method of a :py:meth:`Item._read_bits` generator
+        and returns the value of a single element
+    encode : callable
+        Takes a single element and the ``send`` method of a
+        :py:meth:`Item._write_bits` generator, and emits the element's fields
+    """
+    try:
+        return _format_codecs[format]
+    except KeyError:
+        pass
+    names = ['f{0}'.format(i) for i in range(len(format))]
+    decode = ['def decode(send):']
+    for name, (code, length) in zip(names, format):
+        if code == 'u':
+            decode.append('    {0} = send({1})'.format(name, length))
+        elif code == 'i':
+            # Branchless 2's complement: subtracting the sign bit after
+            # toggling it sign extends without a data-dependent branch
+            top_bit = 1 << (length - 1)
+            decode.append('    {0} = (send({1}) ^ {2}) - {2}'.format(
+                name, length, top_bit))
+        elif code == 'b':
+            decode.append('    {0} = bool(send({1}))'.format(name, length))
+        elif code == 'c':
+            decode.append('    {0} = _int2byte(send(8))'.format(name))
+        elif code == 'f' and length in (32, 64):
+            decode.append('    {0} = _np.uint{1}(send({1})).view(_np.float{1})'.format(
+                name, length))
+        else:
+            raise ValueError('unhandled format {0}'.format((code, length)))
+    if len(names) == 1:
+        decode.append('    return f0')
+    else:
+        decode.append('    return ({0},)'.format(', '.join(names)))
+
+    encode = ['def encode(element, send):']
+    if len(names) == 1:
+        encode.append('    f0 = element')
+    else:
+        encode.append('    {0} = element'.format(', '.join(names)))
+    for name, (code, length) in zip(names, format):
+        if code == 'u':
+            encode.append('    raw = int({0})'.format(name))
+            encode.append('    if raw < 0 or raw >= {0}:'.format(1 << length))
+            encode.append("        raise ValueError('{{}} is out of range for u{0}'"
+                          '.format(raw))'.format(length))
+            encode.append('    send((raw, {0}))'.format(length))
+        elif code == 'i':
+            top_bit = 1 << (length - 1)
+            encode.append('    raw = int({0})'.format(name))
+            encode.append('    if raw < {0} or raw >= {1}:'.format(-top_bit, top_bit))
+            encode.append("        raise ValueError('{{}} is out of range for i{0}'"
+                          '.format({1}))'.format(length, name))
+            # Masking converts to 2's complement without a sign branch
+            encode.append('    send((raw & {0}, {1}))'.format((1 << length) - 1, length))
+        elif code == 'b':
+            encode.append('    send((1 if {0} else 0, {1}))'.format(name, length))
+        elif code == 'c':
+            encode.append('    send((ord({0}), 8))'.format(name))
+        else:   # 'f', validated above
+            # int() keeps the raw bits out of numpy scalar arithmetic: a
+            # numpy uint fed to _write_bits turns its accumulator into
+            # int64, which overflows once later fields push past 64 bits
+            encode.append('    send((int(_np.float{1}({0}).view(_np.uint{1})), {1}))'.format(
+                name, length))
+
+    namespace = {'_np': _np, '_int2byte': six.int2byte}
+    exec(compile('\n'.join(decode + [''] + encode), '<spead2 format codec>', 'exec'),
+         namespace)
+    codec = (namespace['decode'], namespace['encode'])
+    _format_codecs[format] = codec
+    return codec
+
+
+_numpy_header_prefixes = {}
+
+
+def _numpy_header_prefix(dtype, fortran_order):
+    """Prefix of a numpy header, up to but excluding the shape.
+
+    Converting a dtype to its descriptor is surprisingly expensive, and the
+    same few dtypes tend to be used over and over, so cache the result per
+    (dtype, fortran_order) pair.
+    """
+    key = (dtype, fortran_order)
+    try:
+        return _numpy_header_prefixes[key]
+    except KeyError:
+        prefix = "{{'descr': {!r}, 'fortran_order': {!r}, 'shape': ".format(
+                _np.lib.format.dtype_to_descr(dtype), fortran_order)
+        _numpy_header_prefixes[key] = prefix
+        return prefix
+
+
 def parse_range_list(ranges):
     """Split a string like 2,3-5,8,9-11 into a list of integers. This is
     intended to ease adding command-line options for dealing with affinity.
@@ -119,9 +243,26 @@ class Descriptor(object):
     format : list of pairs, optional
         Structure fields for generic (non-numpy) type. Each element of the list
         is a tuple of field code and bit length.
+    swap_on_receive : bool, optional
+        If true (the default), received data with a non-native byte order is
+        converted to native order, which makes later calculations efficient.
+        Consumers that only forward or store values can pass false to skip
+        that pass over the payload; the value then keeps the transmitted
+        byte order in its dtype, and numpy converts on access as needed.
     """
 
-    def __init__(self, id, name, description, shape, dtype=None, order='C', format=None):
+    # Slots turn attribute access on the hot decode paths into fixed-offset
+    # loads instead of dict lookups. __weakref__ must be listed explicitly:
+    # the send path keeps weak references to items.
+    __slots__ = ('__weakref__',
+                 'id', 'name', 'description', 'shape', 'dtype', 'order',
+                 'format', 'swap_on_receive', '_internal_dtype', '_fastpath',
+                 '_has_variable', '_unknown_pos', '_known_product',
+                 '_itemsize_bits', '_codec_codes', '_codec_lengths',
+                 '_bool_bitmask', '_decode_element', '_encode_element')
+
+    def __init__(self, id, name, description, shape, dtype=None, order='C', format=None,
+                 swap_on_receive=True):
         shape = tuple(shape)
         unknowns = sum([x is None for x in shape])
         if unknowns > 1:
@@ -151,7 +292,12 @@ class Descriptor(object):
         self.dtype = dtype
         self.order = order
         self.format = format
+        self.swap_on_receive = swap_on_receive
         if not self._internal_dtype.hasobject:
+            # This includes formats where every field is byte-aligned, since
+            # _parse_format converts those to a plain numpy dtype. They are
+            # decoded with a single frombuffer-style view rather than
+            # per-element bit unpacking.
             self._fastpath = _FASTPATH_NUMPY
         elif (not shape and
                 dtype is None and
@@ -161,12 +307,50 @@ class Descriptor(object):
             self._fastpath = _FASTPATH_IMMEDIATE
         else:
             self._fastpath = _FASTPATH_NONE
+        self._has_variable = None in shape
+        if self._has_variable:
+            self._unknown_pos = shape.index(None)
+            self._known_product = _shape_elements(
+                    x for x in shape if x is not None)
+        else:
+            self._unknown_pos = -1
+            self._known_product = _shape_elements(shape)
+        # Cache quantities that set_from_raw/to_buffer would otherwise
+        # recompute for every heap.
+        if format is not None:
+            self._itemsize_bits = sum(field[1] for field in format)
+        else:
+            self._itemsize_bits = dtype.itemsize * 8
+        # Precompiled codec for formats that need bit-level packing. Fields
+        # wider than 64 bits are rare and keep the generator path.
+        self._codec_codes = None
+        self._codec_lengths = None
+        if (_bitcodec.have_numba and
+                format is not None and
+                self._internal_dtype.hasobject and
+                all(field[1] <= 64 for field in format)):
+            self._codec_codes = _np.array(
+                    [_bitcodec.CODE_MAP[field[0]] for field in format], _np.uint64)
+            self._codec_lengths = _np.array(
+                    [field[1] for field in format], _np.uint64)
+        # Single-bit booleans are just a bitmask, which numpy can pack and
+        # unpack wholesale (whole-byte booleans already use the numpy path)
+        self._bool_bitmask = (format is not None and len(format) == 1 and
+                              format[0][0] == 'b' and format[0][1] == 1)
+        # Specialized per-element functions for the generator fallback path
+        self._decode_element = None
+        self._encode_element = None
+        if (format is not None and
+                self._internal_dtype.hasobject and
+                self._codec_codes is None):
+            self._decode_element, self._encode_element = _compile_format_codec(
+                    tuple((field[0], field[1]) for field in format))
 
     @classmethod
     def _parse_numpy_header(cls, header):
         try:
-            d = _np.lib.utils.safe_eval(header)
-        except SyntaxError as e:
+            d = _ast.literal_eval(header)
+        except (ValueError, SyntaxError) as e:
             msg = "Cannot parse descriptor: %r\nException: %r"
             raise ValueError(msg % (header, e))
         if not isinstance(d, dict):
@@ -195,9 +379,7 @@ class Descriptor(object):
 
     @classmethod
     def _make_numpy_header(self, shape, dtype, order):
-        return "{{'descr': {!r}, 'fortran_order': {!r}, 'shape': {!r}}}".format(
-                _np.lib.format.dtype_to_descr(dtype), order == 'F',
-                tuple(shape))
+        return _numpy_header_prefix(dtype, order == 'F') + repr(tuple(shape)) + '}'
 
     @classmethod
     def _parse_format(cls, fmt):
@@ -231,14 +413,11 @@ class Descriptor(object):
     @property
     def itemsize_bits(self):
         """Number of bits per element"""
-        if self.dtype is not None:
-            return self.dtype.itemsize * 8
-        else:
-            return sum(x[1] for x in self.format)
+        return self._itemsize_bits
 
     def is_variable_size(self):
         """Determine whether any element of the size is dynamic"""
-        return any([x is None for x in self.shape])
+        return self._has_variable
 
     def allow_immediate(self):
         """Called by the C++ interface to determine whether sufficiently small
@@ -257,27 +436,21 @@ class Descriptor(object):
         """Determine the dynamic shape, given incoming data that is big enough
         to hold `max_elements` elements.
         """
-        known = 1
-        unknown_pos = -1
-        for i, x in enumerate(self.shape):
-            if x is not None:
-                known *= x
-            else:
-                assert unknown_pos == -1, 'Shape has multiple unknown dimensions'
-                unknown_pos = i
-        if unknown_pos == -1:
+        if not self._has_variable:
             return self.shape
+        shape = list(self.shape)
+        if self._known_product == 0:
+            shape[self._unknown_pos] = 0
         else:
-            shape = list(self.shape)
-            if known == 0:
-                shape[unknown_pos] = 0
-            else:
-                shape[unknown_pos] = max_elements // known
-            return shape
+            shape[self._unknown_pos] = max_elements // self._known_product
+        return shape
 
     def compatible_shape(self, shape):
         """Determine whether `shape` is compatible with the (possibly
         variable-sized) shape for this descriptor"""
+        if not self._has_variable:
+            # Fully fixed shape: tuple comparison is a single C call
+            return tuple(shape) == self.shape
         if len(shape) != len(self.shape):
             return False
         for x, y in zip(self.shape, shape):
@@ -331,6 +504,8 @@ class Item(Descriptor):
         Initial value
     """
 
+    __slots__ = ('_value', 'version')
+
     def __init__(self, *args, **kw):
         value = kw.pop('value', None)
         super(Item, self).__init__(*args, **kw)
@@ -365,16 +540,27 @@ class Item(Descriptor):
         """
         have_bits = 0
         bits = 0
-        byte_source = iter(bytearray(raw_value))
+        try:
+            # Avoid copying the payload just to read from it
+            data = memoryview(raw_value)
+        except TypeError:
+            # Python 2 old-style buffer objects
+            data = bytearray(raw_value)
+        size = len(data)
+        offset = 0
         result = 0
         while True:
             need_bits = yield result
             while have_bits < need_bits:
-                try:
-                    bits = (bits << 8) | next(byte_source)
-                    have_bits += 8
-                except StopIteration:
+                # Top up 8 bytes at a time rather than byte-by-byte; Python
+                # ints are arbitrary precision, so the accumulator can hold
+                # a partial field plus a whole word.
+                chunk = data[offset:offset + 8]
+                if offset >= size:
                     return
+                offset += 8
+                bits = (bits << (8 * len(chunk))) | _int_from_bytes(chunk)
+                have_bits += 8 * len(chunk)
             result = int(bits >> (have_bits - need_bits))
             bits &= (1 << (have_bits - need_bits)) - 1
             have_bits -= need_bits
@@ -405,81 +591,25 @@ class Item(Descriptor):
                 current <<= (8 - current_bits)
                 array[pos] = current
 
-    def _load_recursive(self, shape, gen):
-        """Recursively create a multidimensional array (as lists of lists)
-        from a bit generator.
+    def _load_flat(self, elements, gen):
+        """Create a flat array of `elements` elements from a bit generator
+        created by :py:meth:`_read_bits`.
         """
-        if len(shape) > 0:
-            ans = []
-            for i in range(shape[0]):
-                ans.append(self._load_recursive(shape[1:], gen))
-        else:
-            fields = []
-            for code, length in self.format:
-                field = None
-                raw = gen.send(length)
-                if code == 'u':
-                    field = raw
-                elif code == 'i':
-                    field = raw
-                    # Interpret as 2's complement
-                    if field >= 1 << (length - 1):
-                        field -= 1 << length
-                elif code == 'b':
-                    field = bool(raw)
-                elif code == 'c':
-                    field = six.int2byte(raw)
-                elif code == 'f':
-                    if length == 32:
-                        field = _np.uint32(raw).view(_np.float32)
-                    elif length == 64:
-                        field = _np.uint64(raw).view(_np.float64)
-                    else:
-                        raise ValueError('unhandled float length {0}'.format((code, length)))
-                else:
-                    raise ValueError('unhandled format {0}'.format((code, length)))
-                fields.append(field)
-            if len(fields) == 1:
-                ans = fields[0]
-            else:
-                ans = tuple(fields)
-        return ans
-
-    def _store_recursive(self, dims, value, gen):
-        if dims > 0:
-            for sub in value:
-                self._store_recursive(dims - 1, sub, gen)
-        else:
-            if len(self.format) == 1:
-                value = (value,)
-            for (code, length), field in zip(self.format, value):
-                raw = None
-                if code == 'u':
-                    raw = int(field)
-                    if raw < 0 or raw >= (1 << length):
-                        raise ValueError('{} is out of range for u{}'.format(raw, length))
-                elif code == 'i':
-                    top_bit = 1 << (length - 1)
-                    raw = int(field)
-                    if raw < -top_bit or raw >= top_bit:
-                        raise ValueError('{} is out of range for i{}'.format(field, length))
-                    # convert to 2's complement
-                    if raw < 0:
-                        raw += 2 * top_bit
-                elif code == 'b':
-                    raw = 1 if field else 0
-                elif code == 'c':
-                    raw = ord(field)
-                elif code == 'f':
-                    if length == 32:
-                        raw = _np.float32(field).view(_np.uint32)
-                    elif length == 64:
-                        raw = _np.float64(field).view(_np.uint64)
-                    else:
-                        raise ValueError('unhandled float length {0}'.format((code, length)))
-                else:
-                    raise ValueError('unhandled format {0}'.format((code, length)))
-                gen.send((raw, length))
+        out = _np.empty(elements, self._internal_dtype)
+        decode = self._decode_element
+        send = gen.send
+        for i in range(elements):
+            out[i] = decode(send)
+        return out
+
+    def _store_flat(self, value, gen):
+        """Feed a flat array through a bit generator created by
+        :py:meth:`_write_bits`.
+        """
+        encode = self._encode_element
+        send = gen.send
+        for element in value:
+            encode(element, send)
 
     def set_from_raw(self, raw_item):
         raw_value = raw_item.value
@@ -498,8 +628,12 @@ class Item(Descriptor):
             else:
                 array1d = _np.array(raw_value, copy=False)[:size_bytes]
             array1d = array1d.view(dtype=self._internal_dtype)
-            # Force to native endian
-            array1d = array1d.astype(self._internal_dtype.newbyteorder('='), casting='equiv', copy=False)
+            # Force to native endian. byteswap writes into a fresh buffer
+            # (the payload may be shared, so it must not be swapped in place),
+            # but unlike astype it does not go through casting machinery.
+            if not array1d.dtype.isnative and self.swap_on_receive:
+                array1d = array1d.byteswap(False).view(
+                        self._internal_dtype.newbyteorder('='))
             value = _np.reshape(array1d, shape, self.order)
         elif (self._fastpath == _FASTPATH_IMMEDIATE and
                 raw_item.is_immediate and
@@ -523,9 +657,27 @@ class Item(Descriptor):
                 size_bytes = (bits + 7) // 8
                 raw_value = raw_value[-size_bytes:]
 
-            gen = self._read_bits(raw_value)
-            gen.send(None)    # Initialisation of the generator
-            value = _np.array(self._load_recursive(shape, gen), self._internal_dtype)
+            if self._bool_bitmask:
+                bitmask = _np.unpackbits(_np.array(raw_value, copy=False))
+                value = bitmask[:elements].astype(bool).astype(self._internal_dtype)
+                value = value.reshape(shape)
+            elif self._codec_codes is not None:
+                fields = _bitcodec.unpack_fields(
+                        _np.array(raw_value, copy=False),
+                        self._codec_codes, self._codec_lengths, elements)
+                if len(fields) == 1:
+                    value = fields[0].astype(self._internal_dtype)
+                else:
+                    value = _np.empty(elements, self._internal_dtype)
+                    for name, field in zip(value.dtype.names, fields):
+                        if value.dtype.fields[name][0].hasobject:
+                            field = field.astype(_np.object_)
+                        value[name] = field
+                value = value.reshape(shape)
+            else:
+                gen = self._read_bits(raw_value)
+                gen.send(None)    # Initialisation of the generator
+                value = self._load_flat(elements, gen).reshape(shape)
 
         if len(self.shape) == 0 and isinstance(value, _np.ndarray):
             # Convert zero-dimensional array to scalar
@@ -536,9 +688,14 @@ class Item(Descriptor):
         self.value = value
 
     def _num_elements(self):
-        if isinstance(self.value, _np.ndarray):
-            return self.value.size
-        cur = self.value
+        value = self.value
+        if isinstance(value, _np.ndarray):
+            return int(value.size)
+        if None not in self.shape:
+            # Fixed shape: no need to walk the (possibly nested) value.
+            # Callers validate the value against the shape separately.
+            return _shape_elements(self.shape)
+        cur = value
         ans = 1
         for size in self.shape:
             ans *= len(cur)
@@ -591,23 +748,30 @@ class Item(Descriptor):
         """
         value = self._transform_value()
         if self._fastpath != _FASTPATH_NUMPY:
+            if self._bool_bitmask:
+                return _np.packbits(value.reshape(-1).astype(_np.uint8))
             bit_length = self.itemsize_bits * self._num_elements()
             out = bytearray((bit_length + 7) // 8)
+            if self._codec_codes is not None:
+                flat = value.reshape(-1)
+                if len(self.format) == 1:
+                    columns = [flat]
+                else:
+                    columns = [flat[name] for name in flat.dtype.names]
+                _bitcodec.pack_fields(out, self._codec_codes, self._codec_lengths, columns)
+                return out
             gen = self._write_bits(out)
             gen.send(None)  # Initialise the generator
-            # If it's a scalar, unpack it. That way, the input to the
-            # final level of recursion in _store_recursive is always
-            # the scalar rather than the 0D array.
-            if len(self.shape) == 0:
-                value = value[()]
-            self._store_recursive(len(self.shape), value, gen)
+            self._store_flat(value.reshape(-1), gen)
             gen.close()
             return out
         else:
-            if self.order == 'F':
+            if self.order == 'F' and not value.flags.c_contiguous:
                 # numpy doesn't allow buffer protocol to be used on arrays that
                 # aren't C-contiguous, but transposition just fiddles the
-                # strides of the view without creating a new array.
+                # strides of the view without creating a new array. 1-D and
+                # degenerate arrays are already C-contiguous and are passed
+                # through without creating the extra view object.
                 value = value.transpose()
             return value
 
@@ -638,14 +802,8 @@ class ItemGroup(object):
         del self._by_name[item.name]
 
     def _add_item(self, item):
-        try:
-            old = self._by_id[item.id]
-        except KeyError:
-            old = None
-        try:
-            old_by_name = self._by_name[item.name]
-        except KeyError:
-            old_by_name = None
+        old = self._by_id.get(item.id)
+        old_by_name = self._by_name.get(item.name)
 
         # Check if this is just the same thing
         if (old is not None and
@@ -702,14 +860,16 @@ class ItemGroup(object):
 
     def __getitem__(self, key):
         """Dictionary-style lookup by either ID or name"""
-        if isinstance(key, _numbers.Integral):
+        # Plain int check first: the numbers.Integral ABC test is
+        # surprisingly expensive, and only needed for exotic integer types
+        if isinstance(key, int) or isinstance(key, _numbers.Integral):
             return self._by_id[key]
         else:
             return self._by_name[key]
 
     def __contains__(self, key):
         """Dictionary-style membership test by either ID or name"""
-        if isinstance(key, _numbers.Integral):
+        if isinstance(key, int) or isinstance(key, _numbers.Integral):
             return key in self._by_id
         else:
             return key in self._by_name
@@ -747,17 +907,23 @@ class ItemGroup(object):
         dict
             Items that have been updated from this heap, indexed by name
         """
-        for descriptor in heap.get_descriptors():
-            item = Item.from_raw(descriptor, flavour=heap.flavour)
-            self._add_item(item)
+        descriptors = heap.get_descriptors()
+        if descriptors:
+            flavour = heap.flavour
+            for descriptor in descriptors:
+                self._add_item(Item.from_raw(descriptor, flavour=flavour))
         updated_items = {}
+        # Hoist lookups out of the per-item loop
+        by_id = self._by_id
+        ctrl_id = STREAM_CTRL_ID
         for raw_item in heap.get_items():
-            if raw_item.id <= STREAM_CTRL_ID:
+            item_id = raw_item.id
+            if item_id <= ctrl_id:
                 continue     # Special fields, not real items
             try:
-                item = self._by_id[raw_item.id]
+                item = by_id[item_id]
             except KeyError:
-                _logger.warning('Item with ID %#x received but there is no descriptor', raw_item.id)
+                _logger.warning('Item with ID %#x received but there is no descriptor', item_id)
             else:
                 item.set_from_raw(raw_item)
                 item.version += 1
@@ -0,0 +1,258 @@
+# Copyright 2015 SKA South Africa
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Accelerated packing and unpacking of bit fields.
+
+This implements the same algorithms as :py:meth:`spead2.Item._read_bits` and
+:py:meth:`spead2.Item._write_bits`, but compiled with numba and operating on
+whole arrays of elements rather than one field at a time. It is only used for
+formats whose fields do not all fall on byte boundaries (the aligned cases are
+handled by numpy directly), and only when numba is available; otherwise the
+pure Python generators are used.
+
+Field codes are represented numerically so that they can be passed to the
+compiled code and cached on the descriptor: see :py:data:`CODE_MAP`.
+"""
+
+from __future__ import division
+import numpy as _np
+try:
+    import numba as _numba
+except ImportError:
+    _numba = None
+
+
+#: Numeric equivalents of the SPEAD field code characters
+CODE_U = 0
+CODE_I = 1
+CODE_B = 2
+CODE_C = 3
+CODE_F = 4
+CODE_MAP = {'u': CODE_U, 'i': CODE_I, 'b': CODE_B, 'c': CODE_C, 'f': CODE_F}
+
+
+if _numba is not None:
+    @_numba.njit(cache=True)
+    def _unpack_kernel(buf, lengths, out):
+        """Split a big-endian bit stream into raw field values.
+
+        Parameters
+        ----------
+        buf : uint8 1-D array
+            Source bit stream
+        lengths : uint64 1-D array
+            Bit length of each field
+        out : uint64 2-D array, shape (elements, fields)
+            Output array for the raw (unconverted) field values
+        """
+        pos = 0
+        bits = _np.uint64(0)       # Bits not yet consumed, right-aligned
+        have_bits = _np.uint64(0)
+        for e in range(out.shape[0]):
+            for f in range(out.shape[1]):
+                need = lengths[f]
+                result = _np.uint64(0)
+                while need > _np.uint64(0):
+                    if have_bits == _np.uint64(0):
+                        bits = _np.uint64(buf[pos])
+                        pos += 1
+                        have_bits = _np.uint64(8)
+                    take = min(need, have_bits)
+                    have_bits -= take
+                    result = (result << take) | (bits >> have_bits)
+                    bits &= (_np.uint64(1) << have_bits) - _np.uint64(1)
+                    need -= take
+                out[e, f] = result
+
+    @_numba.njit(cache=True)
+    def _pack_kernel(values, lengths, out):
+        """Inverse of :py:func:`_unpack_kernel`.
+
+        Parameters
+        ----------
+        values : uint64 2-D array, shape (elements, fields)
+            Raw field values, each of which must fit in its bit length
+        lengths : uint64 1-D array
+            Bit length of each field
+        out : uint8 1-D array
+            Output bit stream; any partial final byte is zero-padded
+        """
+        pos = 0
+        current = _np.uint64(0)    # Bits not yet written out, right-aligned
+        current_bits = _np.uint64(0)
+        for e in range(values.shape[0]):
+            for f in range(values.shape[1]):
+                need = lengths[f]
+                value = values[e, f]
+                while need > _np.uint64(0):
+                    take = min(_np.uint64(8) - current_bits, need)
+                    need -= take
+                    chunk = (value >> need) & ((_np.uint64(1) << take) - _np.uint64(1))
+                    current = (current << take) | chunk
+                    current_bits += take
+                    if current_bits == _np.uint64(8):
+                        out[pos] = current
+                        pos += 1
+                        current = _np.uint64(0)
+                        current_bits = _np.uint64(0)
+        if current_bits > _np.uint64(0):
+            out[pos] = current << (_np.uint64(8) - current_bits)
+
+
+def _raw_to_logical(code, length, raw):
+    """Convert raw (unsigned) field values to their logical type.
+
+    `raw` is a uint64 array as produced by :py:func:`_unpack_kernel`; the
+    result is a numpy array with the appropriate value type for `code`.
+    """
+    if code == CODE_U:
+        return raw
+    elif code == CODE_I:
+        # Shift the sign bit to the top and back to sign extend
+        shift = 64 - length
+        return (raw.astype(_np.int64) << shift) >> shift
+    elif code == CODE_B:
+        return raw != 0
+    elif code == CODE_C:
+        return raw.astype(_np.uint8).view('S1')
+    elif code == CODE_F:
+        if length == 32:
+            return raw.astype(_np.uint32).view(_np.float32)
+        else:
+            return raw.view(_np.float64)
+    else:
+        raise ValueError('unhandled format code {0}'.format(code))
+
+
+def _logical_to_raw(code, length, values):
+    """Inverse of :py:func:`_raw_to_logical`.
+
+    `values` is a 1-D array (possibly of objects); the result is a uint64
+    array of raw values. Raises :py:exc:`ValueError` if any value is out of
+    range for the field, with the same message as
+    :py:meth:`spead2.Item._store_flat`.
+    """
+    if code == CODE_U:
+        # astype truncates towards zero like the int() the other encoders
+        # use, but can silently wrap values the cast cannot represent; those
+        # (and any conversion failure) are redone element-by-element below
+        # with exactly the scalar semantics.
+        try:
+            with _np.errstate(invalid='ignore'):
+                raw = values.astype(_np.uint64)
+            kind = values.dtype.kind
+            bad = False
+            if length < 64:
+                bad = raw >> _np.uint64(length) != 0
+            if kind == 'f':
+                bad = bad | (values <= -1) | (values != values) | _np.isinf(values)
+            elif kind == 'i':
+                bad = bad | (values < 0)
+        except (TypeError, ValueError, OverflowError):
+            bad = True
+        if not _np.any(bad):
+            return raw
+        raw = _np.empty(len(values), _np.uint64)
+        for i, field in enumerate(values):
+            field = int(field)
+            if field < 0 or field >= (1 << length):
+                raise ValueError('{0} is out of range for u{1}'.format(field, length))
+            raw[i] = field
+        return raw
+    elif code == CODE_I:
+        top_bit = 1 << (length - 1)
+        try:
+            with _np.errstate(invalid='ignore'):
+                signed = values.astype(_np.int64)
+            kind = values.dtype.kind
+            bad = False
+            if length < 64:
+                bad = (signed < -top_bit) | (signed >= top_bit)
+            if kind == 'f':
+                # Values outside the int64 range wrap unpredictably in the
+                # cast, and NaN must raise rather than encode as garbage
+                bad = bad | (values >= 2.0**63) | (values < -2.0**63) | (values != values)
+            elif kind == 'u':
+                bad = bad | (signed < 0)
+        except (TypeError, ValueError, OverflowError):
+            bad = True
+        mask = (1 << length) - 1
+        if not _np.any(bad):
+            raw = signed.view(_np.uint64)
+            if length < 64:
+                raw = raw & _np.uint64(mask)
+            return raw
+        raw = _np.empty(len(values), _np.uint64)
+        for i, field in enumerate(values):
+            converted = int(field)
+            if converted < -top_bit or converted >= top_bit:
+                raise ValueError('{0} is out of range for i{1}'.format(field, length))
+            raw[i] = converted & mask
+        return raw
+    elif code == CODE_B:
+        return values.astype(bool).astype(_np.uint64)
+    elif code == CODE_C:
+        return values.astype('S1').view(_np.uint8).astype(_np.uint64)
+    elif code == CODE_F:
+        if length == 32:
+            return values.astype(_np.float32).view(_np.uint32).astype(_np.uint64)
+        else:
+            return values.astype(_np.float64).view(_np.uint64)
+    else:
+        raise ValueError('unhandled format code {0}'.format(code))
+
+
+def unpack_fields(buf, codes, lengths, elements):
+    """Decode `elements` elements from the bit stream in `buf`.
+
+    Parameters
+    ----------
+    buf : buffer
+        Source bit stream
+    codes, lengths : uint64 1-D arrays
+        Field codes (see :py:data:`CODE_MAP`) and bit lengths
+    elements : int
+        Number of elements to decode
+
+    Returns
+    -------
+    list of numpy arrays
+        One array of length `elements` per field, with the logical value type
+    """
+    raw = _np.empty((elements, len(codes)), dtype=_np.uint64)
+    _unpack_kernel(_np.ascontiguousarray(buf, dtype=_np.uint8), lengths, raw)
+    return [_raw_to_logical(codes[f], int(lengths[f]), raw[:, f])
+            for f in range(len(codes))]
+
+
+def pack_fields(out, codes, lengths, columns):
+    """Encode field columns into the bit stream `out`.
+
+    Parameters
+    ----------
+    out : bytearray
+        Output bit stream, of exactly the right size
+    codes, lengths : uint64 1-D arrays
+        Field codes (see :py:data:`CODE_MAP`) and bit lengths
+    columns : list of 1-D arrays
+        One array per field, with the logical value type
+    """
+    raw = _np.empty((len(columns[0]), len(codes)), dtype=_np.uint64)
+    for f in range(len(codes)):
+        raw[:, f] = _logical_to_raw(codes[f], int(lengths[f]), columns[f])
+    _pack_kernel(raw, lengths, _np.frombuffer(out, dtype=_np.uint8))
+
+
+have_numba = _numba is not None
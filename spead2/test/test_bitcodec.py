@@ -0,0 +1,155 @@
+# Copyright 2015 SKA South Africa
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the bit-level packing and unpacking of format-based items, both
+the numba codec in :py:mod:`spead2._bitcodec` and the generator fallback."""
+
+from __future__ import division, print_function
+import spead2
+from spead2 import _bitcodec
+import numpy as np
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+
+
+class RawItem(object):
+    """Stand-in for the extension's raw item type, with just the attributes
+    that :py:meth:`spead2.Item.set_from_raw` uses."""
+    def __init__(self, value, is_immediate=False, immediate_value=None):
+        self.value = np.frombuffer(bytes(bytearray(value)), np.uint8)
+        self.is_immediate = is_immediate
+        self.immediate_value = immediate_value
+
+
+class BaseTestBitcodec(object):
+    """Round-trip representative formats through :py:meth:`spead2.Item.to_buffer`
+    and :py:meth:`spead2.Item.set_from_raw`.
+
+    The decoder is chosen per descriptor depending on whether numba is
+    available, so subclasses force the choice both ways and the same checks
+    run against both implementations regardless of what is installed in the
+    test environment.
+    """
+
+    use_numba = False
+
+    def setup(self):
+        self._saved_have_numba = _bitcodec.have_numba
+        if self.use_numba and not _bitcodec.have_numba:
+            raise SkipTest('numba is not installed')
+        _bitcodec.have_numba = self.use_numba
+
+    def teardown(self):
+        _bitcodec.have_numba = self._saved_have_numba
+
+    def make_item(self, shape, format, value=None):
+        return spead2.Item(0x2345, 'name', 'description', shape,
+                           format=format, value=value)
+
+    def round_trip(self, shape, format, value):
+        send_item = self.make_item(shape, format, value)
+        recv_item = self.make_item(shape, format)
+        recv_item.set_from_raw(RawItem(send_item.to_buffer()))
+        return recv_item.value
+
+    def test_codec_selection(self):
+        item = self.make_item((3,), [('u', 12)])
+        assert_equal(self.use_numba, item._codec_codes is not None)
+
+    def test_unsigned(self):
+        values = [0, 1, 4095, 2048]
+        assert_equal(values, list(self.round_trip((4,), [('u', 12)], values)))
+
+    def test_signed(self):
+        values = [-2048, 2047, -1, 0]
+        assert_equal(values, list(self.round_trip((4,), [('i', 12)], values)))
+
+    def test_bool(self):
+        # Sub-byte booleans that are not a pure bitmask
+        values = [True, False, True]
+        assert_equal(values, list(self.round_trip((3,), [('b', 4)], values)))
+
+    def test_bool_bitmask(self):
+        # A pure 1-bit boolean format takes the packbits/unpackbits path
+        # rather than either codec
+        values = [True, False, True, True, False, False, True, False, True]
+        item = self.make_item((9,), [('b', 1)], values)
+        assert_equal(b'\xb2\x80', bytes(bytearray(item.to_buffer())))
+        assert_equal(values, list(self.round_trip((9,), [('b', 1)], values)))
+
+    def test_multi_field(self):
+        values = [(7, -4, True), (0, 3, False)]
+        result = self.round_trip((2,), [('u', 4), ('i', 3), ('b', 1)], values)
+        assert_equal(values, [tuple(x) for x in result])
+
+    def test_char_field(self):
+        values = [(1, b'a'), (2, b'z')]
+        result = self.round_trip((2,), [('u', 4), ('c', 8)], values)
+        assert_equal(values, [tuple(x) for x in result])
+
+    def test_float_field(self):
+        values = [(0, 1.5), (1, -2.0)]
+        result = self.round_trip((2,), [('u', 1), ('f', 32)], values)
+        assert_equal(values, [tuple(x) for x in result])
+
+    def test_float_wide_neighbour(self):
+        # A float next to a >56-bit field overflows the encoder's
+        # accumulator if the float's raw bits leak in as a numpy scalar
+        values = [(1.5, (1 << 58) + 7), (-2.0, 0)]
+        result = self.round_trip((2,), [('f', 32), ('u', 59)], values)
+        assert_equal(values, [tuple(x) for x in result])
+
+    def test_double_field(self):
+        values = [(1, 3.14159), (0, -1e300)]
+        result = self.round_trip((2,), [('u', 1), ('f', 64)], values)
+        assert_equal(values, [tuple(x) for x in result])
+
+    def test_wide_field(self):
+        # Fields wider than 64 bits always take the generator fallback
+        values = [1 << 70, 0, 123]
+        assert_equal(values, list(self.round_trip((3,), [('u', 72)], values)))
+
+    def test_multidimensional(self):
+        values = [[1, 2, 3], [4, 5, 6]]
+        result = self.round_trip((2, 3), [('u', 12)], values)
+        assert_equal(values, [list(x) for x in result])
+
+    def test_immediate(self):
+        # Immediates carry the value in the tail of the buffer
+        item = self.make_item((), [('u', 3), ('u', 5)])
+        item.set_from_raw(RawItem(b'\x00\x00\x00\x00\x00\x00\x00\xab',
+                                  is_immediate=True))
+        assert_equal((5, 11), tuple(item.value))
+
+    def test_truncation(self):
+        # Non-integral values truncate towards zero, like int()
+        assert_equal([1, 2, 0], list(self.round_trip((3,), [('u', 12)], [1.5, 2.9, -0.5])))
+        assert_equal([-1, 2], list(self.round_trip((2,), [('i', 12)], [-1.9, 2.5])))
+
+    def test_unsigned_range(self):
+        assert_raises(ValueError, self.make_item((2,), [('u', 12)], [0, 4096]).to_buffer)
+        assert_raises(ValueError, self.make_item((2,), [('u', 12)], [0, -1]).to_buffer)
+
+    def test_signed_range(self):
+        assert_raises(ValueError, self.make_item((2,), [('i', 12)], [0, 2048]).to_buffer)
+        assert_raises(ValueError, self.make_item((2,), [('i', 12)], [0, -2049]).to_buffer)
+
+
+class TestBitcodecNumba(BaseTestBitcodec):
+    use_numba = True
+
+
+class TestBitcodecFallback(BaseTestBitcodec):
+    use_numba = False
@@ -163,6 +163,40 @@ class TestItem(object):
             item.to_raw(spead2.Flavour())
 
 
+class RawItem(object):
+    """Stand-in for the extension's raw item type, providing just the
+    attributes that :py:meth:`spead2.Item.set_from_raw` uses."""
+    def __init__(self, value):
+        self.value = np.frombuffer(bytes(bytearray(value)), np.uint8)
+        self.is_immediate = False
+        self.immediate_value = None
+
+
+class TestSwapOnReceive(object):
+    """Tests for the `swap_on_receive` flag on :py:class:`spead2.Descriptor`"""
+
+    def setup(self):
+        self.dtype = np.dtype(np.uint32).newbyteorder()   # Non-native order
+        self.expected = np.arange(4, dtype=np.uint32)
+        self.raw = RawItem(self.expected.astype(self.dtype).tobytes())
+
+    def test_default_swaps(self):
+        """By default, a received value is converted to native byte order."""
+        item = spead2.Item(0x1000, 'name', 'description', (4,), self.dtype)
+        item.set_from_raw(self.raw)
+        assert_true(item.value.dtype.isnative)
+        np.testing.assert_equal(self.expected, item.value)
+
+    def test_no_swap(self):
+        """With ``swap_on_receive=False`` the transmitted byte order is
+        kept, and the values still compare equal."""
+        item = spead2.Item(0x1000, 'name', 'description', (4,), self.dtype,
+                           swap_on_receive=False)
+        item.set_from_raw(self.raw)
+        assert_equal(self.dtype, item.value.dtype)
+        np.testing.assert_equal(self.expected, item.value)
+
+
 class TestItemGroup(object):
     """Tests for :py:class:`spead2.ItemGroup`"""
 